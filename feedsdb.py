@@ -10,19 +10,121 @@ import time
 import calendar
 import sqlite3
 import argparse
+import uuid
+import socket
 import functools
+import hashlib
 import feedparser
 import datetime
 import xml.etree.ElementTree as ET
 import urllib.error
+import urllib.parse
+import urllib.request
 
 import cgi
 import cgitb
 cgitb.enable()
 
+# How long an updater may hold a feed before another one is allowed to take it
+# over (e.g. if the holder crashed mid-fetch)
+LEASE_PERIOD = 5*60
+
+# Socket timeout for feed fetches, well inside LEASE_PERIOD so a stalled fetch
+# gives up before its lease can be taken over
+FETCH_TIMEOUT = 60
+
+# Cached feed icons are only re-checked (conditionally) this often
+ICON_REFRESH_PERIOD = 24*60*60
+# Icons bigger than this are not cached
+MAX_ICON_SIZE = 256*1024
+# Timeout for icon fetches
+ICON_TIMEOUT = 30
+# Icons are served from the script's own origin, so only raster images are
+# cached (an SVG can carry script)
+ICON_TYPES = {'image/x-icon', 'image/vnd.microsoft.icon', 'image/png', 'image/gif', 'image/jpeg', 'image/webp'}
+
 def do_delete(conn, name):
     conn.execute('DELETE FROM feeds WHERE name = ?', (name,))
     conn.execute('DELETE FROM items WHERE feed = ?', (name,))
+    conn.execute('DELETE FROM leases WHERE feed = ?', (name,))
+    conn.execute('DELETE FROM icons WHERE feed = ?', (name,))
+
+def claim_feed(conn, name, holder, now, force=False):
+    # Atomically take the lease on a feed, succeeding only if nobody else holds
+    # an unexpired lease and (unless forced) the feed is still due. Commits
+    # straight away so the write lock isn't held while the feed is fetched.
+    # The lease runs from when it's claimed, not from the start of the update
+    # (`now`, used for the due check), which may have been several fetches ago
+    claimed_at = int(time.time())
+    due = '' if force else ' AND last_update + poll_period < :now'
+    cursor = conn.execute('''INSERT INTO leases (feed, holder, expires)
+        SELECT name, :holder, :expires FROM feeds WHERE name = :name{}
+        ON CONFLICT(feed) DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+        WHERE leases.expires < :claimed_at'''.format(due),
+        dict(name=name, holder=holder, expires=claimed_at + LEASE_PERIOD, now=now, claimed_at=claimed_at))
+    conn.commit()
+    return cursor.rowcount == 1
+
+def holds_feed(conn, name, holder):
+    # Check the lease is still ours before writing a fetch's results. This is a
+    # (no-op) write so the lock it takes is held until the results are committed
+    # and nobody can take the lease over in between.
+    cursor = conn.execute('UPDATE leases SET expires = expires WHERE feed = ? AND holder = ?', (name, holder))
+    return cursor.rowcount == 1
+
+def release_feed(conn, name, holder):
+    conn.execute('DELETE FROM leases WHERE feed = ? AND holder = ?', (name, holder))
+
+def update_icon(conn, name, url, now, verbose=False):
+    # Download the feed's icon into the database so pages can serve it locally
+    # rather than every item hotlinking the remote URL. Writes are committed
+    # straight away, this is called with the feed's fetch still to come.
+    row = conn.execute('SELECT url, etag, modified, fetched FROM icons WHERE feed = ?', (name,)).fetchone()
+    headers = {}
+    if row and row[0] == url:
+        if row[3] + ICON_REFRESH_PERIOD >= now:
+            return
+        if row[1]:
+            headers['If-None-Match'] = row[1]
+        if row[2]:
+            headers['If-Modified-Since'] = row[2]
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=ICON_TIMEOUT) as r:
+            data = r.read(MAX_ICON_SIZE + 1)
+            # get_content_type() defaults to text/plain if there's no header
+            content_type = r.headers.get_content_type() if r.headers.get('Content-Type') else ''
+            etag = r.headers.get('ETag')
+            modified = r.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            conn.execute('UPDATE icons SET fetched = ? WHERE feed = ?', (now, name))
+            conn.commit()
+        elif verbose:
+            print('error fetching icon for {} ({}): {}'.format(name, url, e))
+        return
+    except (OSError, ValueError) as e:
+        if verbose:
+            print('error fetching icon for {} ({}): {}'.format(name, url, e))
+        return
+
+    if len(data) > MAX_ICON_SIZE:
+        if verbose:
+            print('icon for {} ({}) is over {} bytes, not caching'.format(name, url, MAX_ICON_SIZE))
+        return
+    # Plenty of servers send favicon.ico as application/octet-stream, anything
+    # else that isn't a raster image (e.g. an HTML error page) isn't kept
+    if content_type in ('', 'application/octet-stream'):
+        content_type = 'image/x-icon'
+    elif content_type not in ICON_TYPES:
+        if verbose:
+            print('icon for {} ({}) is {}, not caching'.format(name, url, content_type))
+        return
+    conn.execute('''INSERT INTO icons (feed, url, data, content_type, digest, etag, modified, fetched) VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(feed) DO UPDATE SET url = excluded.url, data = excluded.data, content_type = excluded.content_type,
+        digest = excluded.digest, etag = excluded.etag, modified = excluded.modified, fetched = excluded.fetched''',
+        (name, url, data, content_type, hashlib.sha1(data).hexdigest(), etag, modified, now))
+    conn.commit()
 
 def do_update(conn, force=False, verbose=False):
     # Some feeds don't have IDs on the entries, so just fall back to using the
@@ -31,36 +133,64 @@ def do_update(conn, force=False, verbose=False):
         return getattr(e, 'id', e.link)
 
     now = int(time.time())
-    conn.execute('UPDATE feeds SET updated = 0')
-    cursor = conn.cursor()
-    if force:
-        cursor.execute('SELECT name, url, etag, modified FROM feeds')
-    else:
-        cursor.execute('SELECT name, url, etag, modified FROM feeds WHERE last_update + poll_period < ?', (now,))
-    for name, url, etag, modified in cursor:
-        if verbose:
-            print('{} ({})'.format(name, url))
-        try:
-            feed = feedparser.parse(url, etag=etag, modified=modified)
-        except urllib.error.URLError as e:
+    holder = uuid.uuid4().hex
+    # Updated flags only show what this run fetched, but leave alone any feed
+    # another updater holds, it's about to set (or has just set) its flag
+    conn.execute('''UPDATE feeds SET updated = 0 WHERE last_update < :now
+        AND name NOT IN (SELECT feed FROM leases WHERE expires >= :now)''', dict(now=now))
+    conn.commit()
+    # feedparser has no timeout argument of its own
+    old_timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(FETCH_TIMEOUT)
+    try:
+        # Read the candidates up front so no transaction is open across fetches,
+        # other updaters (e.g. concurrent CGI requests) would block on it
+        if force:
+            feeds = conn.execute('SELECT name, url, etag, modified, icon FROM feeds').fetchall()
+        else:
+            feeds = conn.execute('SELECT name, url, etag, modified, icon FROM feeds WHERE last_update + poll_period < ?', (now,)).fetchall()
+        for name, url, etag, modified, icon in feeds:
+            if not claim_feed(conn, name, holder, now, force):
+                if verbose:
+                    print('{} ({}): being updated elsewhere, skipping'.format(name, url))
+                continue
+
             if verbose:
-                print('error updating {} ({}): {}'.format(name, url, e))
-            continue
-
-        conn.execute('UPDATE feeds SET last_update = ? WHERE name = ?', (now, name))
-        if not feed.feed:
-            # OK, just nothing new (via etag or modified time)
-            continue
-
-        conn.execute('UPDATE feeds SET etag = ?, modified = ?, updated = 1 WHERE name = ?',
-            (getattr(feed, 'etag', None), getattr(feed, 'modified', None), name))
-        for entry in feed.entries:
-            dt = getattr(entry, 'published_parsed', getattr(entry, 'updated_parsed'))
-            day = time.strftime('%Y-%m-%d', dt)
-            timestamp = calendar.timegm(dt)
-            conn.execute('INSERT INTO items (feed, id, title, link, comments_link, pub_date, pub_day, seen) VALUES(?, ?, ?, ?, ?, ?, ?, 0) ON CONFLICT(feed, id) DO UPDATE SET title = excluded.title, link = excluded.link, comments_link = excluded.comments_link',
-                (name, entry_id(entry), entry.title, entry.link, getattr(entry, 'comments', ''), timestamp, day))
-        conn.commit()
+                print('{} ({})'.format(name, url))
+            if icon:
+                update_icon(conn, name, icon, now, verbose)
+            try:
+                feed = feedparser.parse(url, etag=etag, modified=modified)
+            except (urllib.error.URLError, socket.timeout) as e:
+                if verbose:
+                    print('error updating {} ({}): {}'.format(name, url, e))
+                release_feed(conn, name, holder)
+                conn.commit()
+                continue
+
+            if not holds_feed(conn, name, holder):
+                # Took too long and someone else has taken the feed over, their
+                # results win
+                if verbose:
+                    print('lease lost updating {} ({}), dropping results'.format(name, url))
+                conn.rollback()
+                continue
+
+            conn.execute('UPDATE feeds SET last_update = ? WHERE name = ?', (now, name))
+            if feed.feed:
+                conn.execute('UPDATE feeds SET etag = ?, modified = ?, updated = 1 WHERE name = ?',
+                    (getattr(feed, 'etag', None), getattr(feed, 'modified', None), name))
+                for entry in feed.entries:
+                    dt = getattr(entry, 'published_parsed', getattr(entry, 'updated_parsed'))
+                    day = time.strftime('%Y-%m-%d', dt)
+                    timestamp = calendar.timegm(dt)
+                    conn.execute('INSERT INTO items (feed, id, title, link, comments_link, pub_date, pub_day, seen) VALUES(?, ?, ?, ?, ?, ?, ?, 0) ON CONFLICT(feed, id) DO UPDATE SET title = excluded.title, link = excluded.link, comments_link = excluded.comments_link',
+                        (name, entry_id(entry), entry.title, entry.link, getattr(entry, 'comments', ''), timestamp, day))
+            # else OK, just nothing new (via etag or modified time)
+            release_feed(conn, name, holder)
+            conn.commit()
+    finally:
+        socket.setdefaulttimeout(old_timeout)
     conn.execute('''DELETE FROM items WHERE rowid IN (
         SELECT items.rowid FROM items INNER JOIN feeds ON items.feed = feeds.name
         WHERE items.pub_date + feeds.prune_period < ?)''', (now,))
@@ -77,6 +207,12 @@ def with_db(fn):
                     etag TEXT, modified TEXT)''')
             conn.execute('''CREATE TABLE IF NOT EXISTS items (id text, feed text, title text, link text, comments_link text,
                     pub_date INT, pub_day TEXT, seen BOOLEAN DEFAULT 0, PRIMARY KEY (feed, id))''')
+            # Per-feed update leases, so concurrent updaters don't fetch the
+            # same feed twice
+            conn.execute('''CREATE TABLE IF NOT EXISTS leases (feed text PRIMARY KEY, holder text, expires INT)''')
+            # Local copies of each feed's icon
+            conn.execute('''CREATE TABLE IF NOT EXISTS icons (feed text PRIMARY KEY, url text, data BLOB,
+                    content_type TEXT, digest TEXT, etag TEXT, modified TEXT, fetched INT)''')
 
             # Old version didn't have comments_link, check and add it if required
             try:
@@ -96,10 +232,43 @@ def with_db(fn):
             conn.commit()
     return wrapper
 
+def serve_icon(conn, name):
+    row = conn.execute('SELECT data, content_type, digest FROM icons WHERE feed = ?', (name,)).fetchone()
+    if row is None:
+        print('Status: 404 Not Found')
+        print()
+        return
+
+    data, content_type, digest = row
+    etag = '"{}"'.format(digest)
+    if os.environ.get('HTTP_IF_NONE_MATCH') == etag:
+        print('Status: 304 Not Modified')
+        print('ETag: ' + etag)
+        print()
+        return
+
+    # Page links include the digest, so a changed icon gets a new URL and this
+    # one can be cached for a long time
+    print('Content-Type: ' + content_type)
+    print('Content-Length: {}'.format(len(data)))
+    print('Cache-Control: public, max-age=31536000')
+    print('ETag: ' + etag)
+    # Belt and braces, the icon is third-party content on our origin
+    print('X-Content-Type-Options: nosniff')
+    print("Content-Security-Policy: default-src 'none'; style-src 'unsafe-inline'")
+    print()
+    sys.stdout.flush()
+    sys.stdout.buffer.write(data)
+
 @with_db
 def serve_cgi(conn, args):
     form = cgi.FieldStorage()
 
+    # Icon requests from the page itself, don't trigger a feed update for these
+    if form.getfirst('icon'):
+        serve_icon(conn, form.getfirst('icon'))
+        return
+
     # Handle form submits (delete/add feed)
     if form.getfirst('delete'):
         do_delete(conn, form.getfirst('delete'))
@@ -128,20 +297,24 @@ def serve_cgi(conn, args):
     ET.SubElement(head, 'link', rel='stylesheet', href='feeds.css', type='text/css')
     body = ET.SubElement(root, 'body')
 
+    # Locally cached icon URL for each feed that has one
+    icon_srcs = {name: '?' + urllib.parse.urlencode({'icon': name, 'v': digest[:12]})
+        for name, digest in conn.execute('SELECT feed, digest FROM icons')}
+
     # Show list of updated feeds favicons
     updates = ET.SubElement(body, 'div', attrib={'class': 'updates'})
-    for name, updated, icon in conn.execute('SELECT name, updated, icon FROM feeds'):
-        if icon and updated:
-            ET.SubElement(updates, 'img', attrib={'class': name, 'src': icon})
+    for name, updated in conn.execute('SELECT name, updated FROM feeds'):
+        if updated and name in icon_srcs:
+            ET.SubElement(updates, 'img', attrib={'class': name, 'src': icon_srcs[name]})
 
     # All feed items, grouped by day & sorted by priority then date/time
     for day_date, in conn.cursor().execute('SELECT DISTINCT pub_day FROM items ORDER BY pub_day DESC'):
         day = ET.SubElement(body, 'div', attrib={'class': 'day'})
         ET.SubElement(day, 'div', attrib={'class': 'day-date'}).text = day_date
         items = ET.SubElement(day, 'ul')
-        for link, title, feed_name, icon in conn.cursor().execute('SELECT link, title, items.feed, feeds.icon FROM items INNER JOIN feeds on items.feed = feeds.name WHERE pub_day = ? ORDER BY priority, pub_date', (day_date,)):
+        for link, title, feed_name in conn.cursor().execute('SELECT link, title, items.feed FROM items INNER JOIN feeds on items.feed = feeds.name WHERE pub_day = ? ORDER BY priority, pub_date', (day_date,)):
             item = ET.SubElement(items, 'li')
-            ET.SubElement(item, 'img', attrib={'class': feed_name, 'src': icon or ''})
+            ET.SubElement(item, 'img', attrib={'class': feed_name, 'src': icon_srcs.get(feed_name, '')})
             ET.SubElement(item, 'a', href=link).text = title
 
     # Simple form to add a feed
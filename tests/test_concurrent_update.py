@@ -0,0 +1,131 @@
+import argparse
+import collections
+import functools
+import http.server
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import feedsdb
+
+FEEDS = 5
+UPDATERS = 12
+# Longer than sqlite's default 5 second busy timeout, so an updater holding the
+# write lock across a fetch makes the others fail with 'database is locked'
+FEED_DELAY = 6
+
+FEED = '''<?xml version="1.0"?>
+<rss version="2.0"><channel><title>{name}</title><link>http://example.com/</link>
+<item><title>{name} item</title><link>http://example.com/{name}</link>
+<guid>{name}-1</guid><pubDate>{date}</pubDate></item>
+</channel></rss>'''
+
+ICON = b'\x00\x00\x01\x00\x01\x00\x10\x10'
+
+class FeedServer(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] += 1
+        name, ext = os.path.splitext(os.path.basename(self.path))
+        if ext == '.xml':
+            self.server.on_feed(name)
+            time.sleep(self.server.delay)
+            body = FEED.format(name=name,
+                date=time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())).encode()
+            content_type = 'application/rss+xml'
+        else:
+            body = ICON
+            content_type = 'image/x-icon'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+def run_update(db_path):
+    feedsdb.with_db(lambda conn, args: feedsdb.do_update(conn))(argparse.Namespace(db_path=db_path))
+
+def start_server(delay=0, on_feed=lambda name: None):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FeedServer)
+    server.lock = threading.Lock()
+    server.hits = collections.Counter()
+    server.delay = delay
+    server.on_feed = on_feed
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_feeds(db_path, server, count):
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    for i in range(count):
+        feedsdb.add_feed(argparse.Namespace(db_path=db_path, name='feed{}'.format(i),
+            url='{}/feed{}.xml'.format(base, i), icon_url='{}/icon{}.ico'.format(base, i),
+            priority=0, poll_period=60*60, prune_period=7*24*60*60))
+
+def test_concurrent_update(tmp_path):
+    server = start_server(delay=FEED_DELAY)
+    db_path = str(tmp_path / 'feeds.db')
+    add_feeds(db_path, server, FEEDS)
+
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=run_update, args=(db_path,)) for _ in range(UPDATERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    server.shutdown()
+
+    assert [p.exitcode for p in procs] == [0] * UPDATERS
+    for i in range(FEEDS):
+        assert server.hits['/feed{}.xml'.format(i)] == 1
+        assert server.hits['/icon{}.ico'.format(i)] == 1
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == FEEDS
+        assert conn.execute('SELECT COUNT(*) FROM icons').fetchone()[0] == FEEDS
+        assert conn.execute('SELECT COUNT(*) FROM feeds WHERE updated = 1').fetchone()[0] == FEEDS
+        assert conn.execute('SELECT COUNT(*) FROM leases').fetchone()[0] == 0
+
+def test_expired_lease_taken_over(tmp_path):
+    server = start_server()
+    db_path = str(tmp_path / 'feeds.db')
+    add_feeds(db_path, server, 2)
+    with sqlite3.connect(db_path) as conn:
+        # feed0's holder crashed a while ago, feed1's is still fetching
+        conn.execute("INSERT INTO leases VALUES ('feed0', 'crashed', ?)", (int(time.time()) - 1,))
+        conn.execute("INSERT INTO leases VALUES ('feed1', 'running', ?)", (int(time.time()) + 60,))
+
+    run_update(db_path)
+    server.shutdown()
+
+    assert server.hits['/feed0.xml'] == 1
+    assert server.hits['/feed1.xml'] == 0
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT feed FROM items').fetchall() == [('feed0',)]
+        assert conn.execute('SELECT feed, holder FROM leases').fetchall() == [('feed1', 'running')]
+
+def test_lost_lease_drops_results(tmp_path):
+    db_path = str(tmp_path / 'feeds.db')
+
+    # Another updater takes the feed over while this one is still fetching it
+    def take_over(name):
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("UPDATE leases SET holder = 'other' WHERE feed = ?", (name,))
+
+    server = start_server(on_feed=take_over)
+    add_feeds(db_path, server, 1)
+
+    run_update(db_path)
+    server.shutdown()
+
+    assert server.hits['/feed0.xml'] == 1
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+        assert conn.execute('SELECT last_update, updated FROM feeds').fetchall() == [(0, 0)]
+        assert conn.execute('SELECT feed, holder FROM leases').fetchall() == [('feed0', 'other')]
@@ -0,0 +1,170 @@
+import argparse
+import hashlib
+import http.server
+import io
+import os
+import sqlite3
+import sys
+import threading
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import feedsdb
+
+ICON = b'\x00\x00\x01\x00\x01\x00\x10\x10'
+DIGEST = hashlib.sha1(ICON).hexdigest()
+
+class IconServer(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        content_type, body, etag = self.server.responses[self.path]
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+def start_server(responses):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), IconServer)
+    server.responses = responses
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+def make_db(tmp_path, icon=True):
+    db_path = str(tmp_path / 'feeds.db')
+    feedsdb.add_feed(argparse.Namespace(db_path=db_path, name='feed0', url='http://example.com/feed.xml',
+        icon_url='http://example.com/favicon.ico', priority=0, poll_period=60*60, prune_period=7*24*60*60))
+    conn = sqlite3.connect(db_path)
+    if icon:
+        conn.execute('''INSERT INTO icons (feed, url, data, content_type, digest, etag, modified, fetched)
+            VALUES('feed0', 'http://example.com/favicon.ico', ?, 'image/x-icon', ?, '"abc"', NULL, 0)''',
+            (ICON, DIGEST))
+        conn.commit()
+    return db_path, conn
+
+def capture_stdout(monkeypatch):
+    out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    monkeypatch.setattr(sys, 'stdout', out)
+    def read():
+        out.flush()
+        headers, body = out.buffer.getvalue().split(b'\n\n', 1)
+        return headers.decode().splitlines(), body
+    return read
+
+def test_serve_icon(tmp_path, monkeypatch):
+    _, conn = make_db(tmp_path)
+    read = capture_stdout(monkeypatch)
+    feedsdb.serve_icon(conn, 'feed0')
+    headers, body = read()
+    assert body == ICON
+    assert 'Content-Type: image/x-icon' in headers
+    assert 'Content-Length: {}'.format(len(ICON)) in headers
+    assert 'ETag: "{}"'.format(DIGEST) in headers
+    assert 'X-Content-Type-Options: nosniff' in headers
+    assert any(h.startswith('Content-Security-Policy: ') for h in headers)
+
+def test_serve_icon_unknown(tmp_path, monkeypatch):
+    _, conn = make_db(tmp_path)
+    read = capture_stdout(monkeypatch)
+    feedsdb.serve_icon(conn, 'nope')
+    headers, body = read()
+    assert headers == ['Status: 404 Not Found']
+    assert body == b''
+
+def test_serve_icon_not_modified(tmp_path, monkeypatch):
+    _, conn = make_db(tmp_path)
+    monkeypatch.setenv('HTTP_IF_NONE_MATCH', '"{}"'.format(DIGEST))
+    read = capture_stdout(monkeypatch)
+    feedsdb.serve_icon(conn, 'feed0')
+    headers, body = read()
+    assert headers[0] == 'Status: 304 Not Modified'
+    assert body == b''
+
+def test_update_icon_not_modified(tmp_path):
+    server, base = start_server({'/favicon.ico': ('image/png', b'new icon', '"abc"')})
+    _, conn = make_db(tmp_path, icon=False)
+    url = base + '/favicon.ico'
+    conn.execute('''INSERT INTO icons (feed, url, data, content_type, digest, etag, modified, fetched)
+        VALUES('feed0', ?, ?, 'image/x-icon', ?, '"abc"', NULL, 0)''', (url, ICON, DIGEST))
+    conn.commit()
+
+    feedsdb.update_icon(conn, 'feed0', url, feedsdb.ICON_REFRESH_PERIOD + 1)
+    server.shutdown()
+
+    assert server.requests[0][1]['If-None-Match'] == '"abc"'
+    assert conn.execute('SELECT data, content_type, digest, fetched FROM icons').fetchall() == [
+        (ICON, 'image/x-icon', DIGEST, feedsdb.ICON_REFRESH_PERIOD + 1)]
+
+def test_update_icon_fresh(tmp_path):
+    server, base = start_server({'/favicon.ico': ('image/png', b'new icon', None)})
+    _, conn = make_db(tmp_path, icon=False)
+    url = base + '/favicon.ico'
+
+    feedsdb.update_icon(conn, 'feed0', url, 1000)
+    feedsdb.update_icon(conn, 'feed0', url, 1000 + feedsdb.ICON_REFRESH_PERIOD)
+    server.shutdown()
+
+    assert len(server.requests) == 1
+    assert conn.execute('SELECT data, content_type, fetched FROM icons').fetchall() == [
+        (b'new icon', 'image/png', 1000)]
+
+def test_update_icon_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(feedsdb, 'MAX_ICON_SIZE', 16)
+    server, base = start_server({
+        '/big.ico': ('image/x-icon', b'x' * 17, None),
+        '/error.html': ('text/html', b'<html>Not here</html>', None),
+        '/icon.svg': ('image/svg+xml', b'<svg/>', None),
+    })
+    _, conn = make_db(tmp_path, icon=False)
+
+    for path in ('/big.ico', '/error.html', '/icon.svg'):
+        feedsdb.update_icon(conn, 'feed0', base + path, 1000)
+    server.shutdown()
+
+    assert len(server.requests) == 3
+    assert conn.execute('SELECT COUNT(*) FROM icons').fetchone()[0] == 0
+
+def test_serve_cgi_icons(tmp_path, monkeypatch):
+    db_path, conn = make_db(tmp_path)
+    conn.executemany('''INSERT INTO items (feed, id, title, link, comments_link, pub_date, pub_day, seen)
+        VALUES('feed0', ?, ?, ?, '', ?, '2026-10-19', 0)''',
+        [(str(i), 'item {}'.format(i), 'http://example.com/{}'.format(i), i) for i in range(3)])
+    conn.commit()
+    updates = []
+    monkeypatch.setattr(feedsdb, 'do_update', lambda conn: updates.append(conn))
+    monkeypatch.setenv('REQUEST_METHOD', 'GET')
+    monkeypatch.setenv('QUERY_STRING', '')
+    read = capture_stdout(monkeypatch)
+
+    feedsdb.serve_cgi(argparse.Namespace(db_path=db_path))
+    _, body = read()
+
+    assert len(updates) == 1
+    root = ET.fromstring(body.split(b'\n', 1)[1])
+    srcs = [img.get('src') for li in root.iter('li') for img in li.iter('img')]
+    assert srcs == ['?icon=feed0&v=' + DIGEST[:12]] * 3
+
+def test_serve_cgi_icon_request(tmp_path, monkeypatch):
+    db_path, _ = make_db(tmp_path)
+    updates = []
+    monkeypatch.setattr(feedsdb, 'do_update', lambda conn: updates.append(conn))
+    monkeypatch.setenv('REQUEST_METHOD', 'GET')
+    monkeypatch.setenv('QUERY_STRING', 'icon=feed0&v=' + DIGEST[:12])
+    read = capture_stdout(monkeypatch)
+
+    feedsdb.serve_cgi(argparse.Namespace(db_path=db_path))
+    headers, body = read()
+
+    assert updates == []
+    assert 'Content-Type: image/x-icon' in headers
+    assert body == ICON